@@ -2,12 +2,28 @@ import logging
 import sys
 import os
 import json
-from datetime import datetime
+import functools
+import hashlib
+import threading
 from datetime import date
 from dateutil.relativedelta import relativedelta
+from cachetools import TTLCache, cached
 
 from BaserowAutomationsFile import BaserowAutomations       # type: ignore
-from flask import Flask, send_file, render_template, url_for
+from flask import Flask, send_file, render_template, url_for, request, make_response
+
+"""
+Configuration
+Read once at startup, so a missing variable fails here and not as a Baserow
+authentication error on the first request
+"""
+BASEROW_TOKEN = os.environ['baserow_token']
+ACTIVISTS_ID = os.environ['activists_table_id']
+EVENT_REG_ID = os.environ['event_registration_table_id']
+RECRUITMENT_ID = os.environ['recruitment_table_id']
+
+# How long (in seconds) the trainings page is reused, by us and by browsers
+PAGE_CACHE_SECONDS = 60
 
 """
 Flask routes
@@ -15,64 +31,53 @@ Flask routes
 app = Flask(__name__)
 @app.route("/")
 def index():
-    training_dic = getTrainingParticipantCounts()
-    return render_template('trainings.html', training_dic=training_dic)
+    html, etag = renderTrainingsPage()
+    response = make_response(html)
+    response.set_etag(etag)
+    response.cache_control.max_age = PAGE_CACHE_SECONDS
+    # answers 304 Not Modified if the browser already has this version
+    return response.make_conditional(request)
 
 """
-A function that gets the number of participants that are registered for each training
-The data is fetched from Baserow
+The rendered trainings page and its ETag
+Reused for PAGE_CACHE_SECONDS so page refreshes don't hit Baserow. The cache is
+shared by the server's threads; when it expires, one request refreshes it and
+the others wait for its result instead of all querying Baserow
 """
-def getTrainingParticipantCounts():
-    baserowAccess = BaserowAutomations(
-        baserow_token=os.environ.get('baserow_token'),
-        activists_table_id=os.environ.get('activists_table_id'),
-        event_reg_table_id=os.environ.get('event_registration_table_id'),
-        recruitment_table_id=os.environ.get('recruitment_table_id')
-    ) 
-
-    registers = baserowAccess.get_all_registrations()
-    training_dic = {}
-    for register in registers:        
-        submission_time_str = register["Submission Time"]
-        # Assuming 'Submission Time' is in the format 2025-06-05T12:56:10.630Z
-        pharsed_date = parse_date(submission_time_str)
-
-        if pharsed_date is None:
-            continue
-
-        if pharsed_date.date() < date.today() - relativedelta(months=2):
-            continue
-
-        training = register["רישום לאירוע"]
-        
-        if training not in training_dic:
-            training_dic[training] = 1
-        else:
-            training_dic[training] += 1
+_page_cache_lock = threading.Lock()
 
-    return training_dic
-
-    app.run(port=int(os.environ.get('PORT', 8080)))
+@cached(TTLCache(maxsize=1, ttl=PAGE_CACHE_SECONDS), lock=_page_cache_lock,
+        condition=threading.Condition(_page_cache_lock))
+def renderTrainingsPage():
+    training_dic = getTrainingParticipantCounts()
+    html = render_template('trainings.html', training_dic=training_dic)
+    return html, hashlib.sha1(html.encode()).hexdigest()
 
 """
-Helper functions
+Baserow access
+The client (and its table handles) is built once per process
 """
-def parse_date(date_str):
-    date_formats = ["%m/%d/%Y %I:%M%p", "%Y-%m-%dT%H:%M:%S.%fZ", '%Y-%m-%dT%H:%M:%SZ']
-    format_successful = False
-    parsed_date = None
+@functools.lru_cache(maxsize=1)
+def get_baserow():
+    return BaserowAutomations(
+        baserow_token=BASEROW_TOKEN,
+        activists_table_id=ACTIVISTS_ID,
+        event_reg_table_id=EVENT_REG_ID,
+        recruitment_table_id=RECRUITMENT_ID
+    )
 
-    for fmt in date_formats:
-        try:
-            parsed_date = datetime.strptime(date_str, fmt)
-            format_successful = True
-            break  # Exit the inner loop if parsing is successful
-        except ValueError as ex:
-            pass  # Try the next format if parsing fails
+"""
+Registrations older than this are not counted
+"""
+REGISTRATIONS_WINDOW = relativedelta(months=2)
 
-    if not format_successful:
-        print("could not parse date " + date_str)
-        return None
-    
-    return parsed_date
+"""
+A function that gets the number of participants that are registered for each training
+The data is fetched from Baserow
+"""
+def getTrainingParticipantCounts():
+    since = date.today() - REGISTRATIONS_WINDOW
+    return get_baserow().get_training_counts_since(since)
 
+if __name__ == '__main__':
+    app.run(port=int(os.environ.get('PORT', 8080)))
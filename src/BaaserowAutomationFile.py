@@ -1,32 +1,81 @@
+from collections import Counter, defaultdict
 from collections.abc import Callable
 from baserowapi import Baserow, Filter
+from datetime import datetime
+import functools
 import logging
 import sys
 from typing import Callable, List
 
 logger = logging.getLogger(__name__)
 
-def _compute_id_control_digit(id_num):
-    """Computes the remainder of the check_digit of the id. If valid, the return value is 0."""
+# Maximal number of rows Baserow accepts in a single batch update request
+BATCH_UPDATE_SIZE = 200
+# Maximal number of rows Baserow returns in a single page
+ROWS_PAGE_SIZE = 200
+# Field types Baserow can filter by date
+DATE_FIELD_TYPES = ('date', 'created_on', 'last_modified')
+
+def _intern(value):
+    """Interns value if it's a string, so that repeated values (e.g. phone
+    numbers used as dict keys across tables) share one object and hash."""
+    return sys.intern(value) if isinstance(value, str) else value
+
+def parse_date(date_str):
+    date_formats = ["%m/%d/%Y %I:%M%p", "%Y-%m-%dT%H:%M:%S.%fZ", '%Y-%m-%dT%H:%M:%SZ']
+    format_successful = False
+    parsed_date = None
+
+    for fmt in date_formats:
+        try:
+            parsed_date = datetime.strptime(date_str, fmt)
+            format_successful = True
+            break  # Exit the inner loop if parsing is successful
+        except ValueError as ex:
+            pass  # Try the next format if parsing fails
+
+    if not format_successful:
+        print("could not parse date " + date_str)
+        return None
+    
+    return parsed_date
+
+def _submitted_since(row, since):
+    """Whether the registration row's (textual) Submission Time is on or after
+    the date since. Rows with a missing or unparsable date are skipped."""
+    if not row['Submission Time']:
+        return False
+    submission_time = parse_date(row['Submission Time'])
+    return submission_time is not None and submission_time.date() >= since
+
+# Maps each digit d to the sum of digits of 2*d (e.g. 7 -> 14 -> 5)
+_DOUBLED_DIGIT_SUMS = str.maketrans('0123456789', '0246813579')
+
+@functools.lru_cache(maxsize=100_000)
+def _id_control_digit_or_none(id_num):
+    """Computes the remainder of the check_digit of the id, or None if it isn't
+    a 9 digits number (after zero padding). Results are cached, as the same IDs
+    are checked over and over by validate_ids and fill_name_by_id."""
     id_num = id_num.zfill(9)
-    assert isinstance(id_num, str) and len(id_num) == 9 and id_num.isnumeric()
-
-    total = 0
-    for i in range(9):
-        val = int(id_num[i]) # converts char to int
-        if i%2 == 0:        # even index (0,2,4,6,8)
-            total += val
-        else:               # odd index (1,3,5,7,9)
-            if val < 5:
-                total += 2*val
-            else:
-                total += ((2*val)%10) + 1 # sum of digits in 2*val
-                                          # 'tens' digit must be 1
+    if not (isinstance(id_num, str) and len(id_num) == 9 and id_num.isnumeric()):
+        return None
+    if not id_num.isascii():
+        # other Unicode digits (e.g. Arabic-Indic); the table below is ASCII only
+        id_num = ''.join(str(int(c)) for c in id_num)
+
+    # even indices (0,2,4,6,8) count as is, odd ones (1,3,5,7) are doubled
+    total = sum(map(int, id_num[0::2] + id_num[1::2].translate(_DOUBLED_DIGIT_SUMS)))
     total = total%10            # 'ones' (rightmost) digit
     check_digit = (10-total)%10 # the complement modulo 10 of total
                                 # for example 42->8, 30->0
     return check_digit
 
+def _compute_id_control_digit(id_num):
+    """Computes the remainder of the check_digit of the id. If valid, the return value is 0."""
+    check_digit = _id_control_digit_or_none(id_num)
+    assert check_digit is not None
+    return check_digit
+
 class BaserowAutomations:
     def __init__(self, baserow_token, activists_table_id, event_reg_table_id,
                  recruitment_table_id):
@@ -34,6 +83,11 @@ class BaserowAutomations:
         self.table_activists = self.baserow.get_table(activists_table_id)
         self.table_event_registration = self.baserow.get_table(event_reg_table_id)
         self.recruitment_table = self.baserow.get_table(recruitment_table_id)
+        # {(table id, partial field name): full field name}
+        self._field_full_names = {}
+        # whether Baserow can filter registrations by Submission Time, see
+        # _can_filter_registrations_by_date
+        self._registrations_date_filterable = None
 
     def update_row_safe(self, row):
         try:
@@ -41,6 +95,31 @@ class BaserowAutomations:
         except Exception as e:
             print(e)
 
+    def _flush_updates(self, table, pending):
+        """Sends the pending updates ({'id': row_id, field: value, ...} dicts)
+        to table using Baserow's batch endpoint, BATCH_UPDATE_SIZE rows per
+        request, and empties pending. A batch is all-or-nothing, so if one
+        fails its rows are retried one by one, and only the bad ones are lost."""
+        for i in range(0, len(pending), BATCH_UPDATE_SIZE):
+            batch = pending[i:i + BATCH_UPDATE_SIZE]
+            try:
+                table.update_rows(batch, batch_size=BATCH_UPDATE_SIZE)
+            except Exception as e:
+                logger.warning(f'Batch update of {len(batch)} rows failed, '
+                               f'retrying one by one: {e}')
+                for values in batch:
+                    try:
+                        table.update_rows([values])
+                    except Exception as e:
+                        logger.error(f'Failed to update row {values["id"]}: {e}')
+        pending.clear()
+
+    def _queue_update(self, table, pending, values):
+        """Appends values to pending, flushing it once a full batch is ready."""
+        pending.append(values)
+        if len(pending) >= BATCH_UPDATE_SIZE:
+            self._flush_updates(table, pending)
+
     def get_all_activists(self): 
         return self.table_activists.get_rows()
 
@@ -50,12 +129,54 @@ class BaserowAutomations:
     def get_all_registrations(self): 
         return self.table_event_registration.get_rows()
 
+    @staticmethod
+    def _registered_since_filter(since):
+        return Filter('Submission Time', since.isoformat(), 'date_after_or_equal')
+
+    def _can_filter_registrations_by_date(self):
+        """Whether Submission Time is a date field, which Baserow can filter by
+        date. If it's a text column (e.g. filled by a form integration), a date
+        filter is rejected by Baserow. Checked once, as the schema doesn't
+        change during a run."""
+        if self._registrations_date_filterable is None:
+            field_type = self.table_event_registration.fields['Submission Time'].type
+            self._registrations_date_filterable = field_type in DATE_FIELD_TYPES
+            logger.info(f'Submission Time is a {field_type} field')
+
+        return self._registrations_date_filterable
+
+    def iter_recent_registrations(self, since, include=None):
+        """Yields the registrations submitted on or after the date since. Pages
+        of ROWS_PAGE_SIZE rows are fetched only as the rows are consumed.
+        If Submission Time is a date field the filtering is done by Baserow, so
+        older rows are never downloaded. Otherwise all rows are fetched and the
+        dates are parsed here.
+        If include is supplied, only these fields are fetched."""
+        table = self.table_event_registration
+        if self._can_filter_registrations_by_date():
+            return table.get_rows(include=include,
+                                  filters=[self._registered_since_filter(since)],
+                                  size=ROWS_PAGE_SIZE, iterator=True)
+
+        if include is not None:
+            include = include + ['Submission Time']
+        rows = table.get_rows(include=include, size=ROWS_PAGE_SIZE, iterator=True)
+        return (row for row in rows if _submitted_since(row, since))
+
+    def get_training_counts_since(self, since):
+        """Returns {training: number of registrations} for the registrations
+        submitted on or after the date since. Only the training column is
+        fetched from Baserow."""
+        rows = self.iter_recent_registrations(since, include=['רישום לאירוע'])
+        return dict(Counter(row['רישום לאירוע'] for row in rows))
+
     def validate_ids(self):
         table = self.table_activists
         id_not_checked_filter = Filter('ת"ז תקינה', '', 'empty')
         id_exists_filter = Filter('ת.ז', '', 'not_empty')
         rows = table.get_rows(filters=[id_not_checked_filter, id_exists_filter])
 
+        pending = []
         for row in rows:
             logger.info(f"{row['שם מלא']}")
             id_num = row['ת.ז']
@@ -67,34 +188,46 @@ class BaserowAutomations:
         
             if id_validation != 0:
                 logger.info(f"{row['שם מלא']}, ID remaining={id_validation}")
-                row['ת"ז תקינה'] = 'לא'
+                id_valid = 'לא'
             else:
                 logger.info(f'{row["שם מלא"]} has a valid ID')
-                row['ת"ז תקינה'] = 'כן'
+                id_valid = 'כן'
             
-            self.update_row_safe(row)
+            if row['ת"ז תקינה'] != id_valid:
+                self._queue_update(table, pending, {'id': row.id, 'ת"ז תקינה': id_valid})
+
+        self._flush_updates(table, pending)
+
+    def _get_field_full_name(self, table, field_name):
+        """Finds the column of table whose name contains field_name (there
+        should be a single one of these) and returns its full name. Written like
+        that in case the name will be drafted one day, to stay as general as
+        possible. Results are cached, as the schema doesn't change during a run."""
+        key = (table.id, field_name)
+        if key not in self._field_full_names:
+            field_full_name = [k for k in table.field_names if field_name in k]
+            if not field_full_name:
+                raise KeyError(f"Can't find a key that contains {field_name} "
+                               f"on table {table.id}")
+            elif len(field_full_name) > 1:
+                raise KeyError(f"Too many columns with a name that contains {field_name}")
+            self._field_full_names[key] = field_full_name[0]
+
+        return self._field_full_names[key]
 
-    def _build_phone_to_field_dict_from_table_rows(self, field_name, table_rows):
-        """Gets a field name and table rows. Finds a field whose name contains 
+    def _build_phone_to_field_dict_from_table(self, field_name, table):
+        """Gets a field name and a table. Finds a field whose name contains 
         field_name (there should be a single one of these), and returns a dict
         from (normalized) phone numbers to the corresponding field values."""
+        field_full_name = self._get_field_full_name(table, field_name)
+        table_rows = table.get_rows(iterator=True)
         phone_to_field = {}
 
         for row in table_rows:
-            # Find the column name that contains field_name. Written like that in
-            # case the name will be drafted one day, to stay as general as possible
-            field_full_name = [k for k in row.fields if field_name in k]
-            if not field_full_name:
-                raise KeyError(f"Can't find a key that contains {field_name}"
-                                f"on the registrations table")
-            elif len(field_full_name) > 1:
-                raise KeyError(f"Too many columns with a name that contains {field_name}")
-            field_full_name = field_full_name[0]
-
             # Store the field content
             field_content = row[field_full_name]
 
-            phone_num = row['_NormalizedPhoneNumber']
+            phone_num = _intern(row['_NormalizedPhoneNumber'])
 
             if field_content:
                 if phone_num in phone_to_field:
@@ -135,36 +268,42 @@ class BaserowAutomations:
             * additional_query_function - if supplied, will be called with the 
             normalized phone number to query for more data to be appended to the
             activists_field."""
-        registration_rows = self.table_event_registration.get_rows()
-        phone_to_field_dict = self._build_phone_to_field_dict_from_table_rows(
-            registration_field, registration_rows)
+        phone_to_field_dict = self._build_phone_to_field_dict_from_table(
+            registration_field, self.table_event_registration)
 
         phone_filter = Filter('_NormalizedPhoneNumber', '', 'not_empty')
         empty_field_filter = Filter(activists_field, '', 'empty')
         filters = [phone_filter] if full_run else [phone_filter, empty_field_filter]
         activists_rows = self.table_activists.get_rows(filters=filters)
+        pending = []
         for row in activists_rows:
-            phone = row['_NormalizedPhoneNumber']
+            phone = _intern(row['_NormalizedPhoneNumber'])
             # add the phone's queried data from the additional query function
             if additional_query_function:
                 queried_values = additional_query_function(phone)
                 self._add_to_dict_if_not_empty(phone, queried_values, phone_to_field_dict)
             
-            # add the current field content, if any
+            # add the current field content, if any. It goes first, so that if
+            # nothing new was found the joined values equal the current content
             if row[activists_field]:
-                self._add_to_dict_if_not_empty(phone, row[activists_field].split(' , '),
-                                               phone_to_field_dict)
+                phone_to_field_dict[phone] = (row[activists_field].split(' , ')
+                                              + phone_to_field_dict.get(phone, []))
             
-            # clear duplicates
+            # clear duplicates, keeping the order of first appearance
             if phone in phone_to_field_dict:
-                phone_to_field_dict[phone] = list(set([url.strip() for url in phone_to_field_dict[phone] if url]))
+                phone_to_field_dict[phone] = list(dict.fromkeys(url.strip() for url in phone_to_field_dict[phone] if url))
             
             if phone in phone_to_field_dict and phone_to_field_dict[phone]:    
+                new_value = ' , '.join(phone_to_field_dict[phone])
+                if new_value == row[activists_field]:
+                    continue
+
                 # update the row
-                logging.warning(f'About to update {row["שם מלא"]} with {" , ".join(phone_to_field_dict[phone])}')
-                row[activists_field] = ' , '.join(phone_to_field_dict[phone])
-                self.update_row_safe(row)
-                logging.warning(f'Updated {row["שם מלא"]}')
+                logging.warning(f'About to update {row["שם מלא"]} with {new_value}')
+                self._queue_update(self.table_activists, pending,
+                                   {'id': row.id, activists_field: new_value})
+
+        self._flush_updates(self.table_activists, pending)
 
     def fill_facebook_from_registration_to_activist(self, phone2fb_db=None, full_run=False):
         """Fills the facebook profile at the activists table from the registrations table. Searches by the phone number.
@@ -198,6 +337,7 @@ class BaserowAutomations:
             return
         
         rows = self.table_activists.get_rows(filters=filters)
+        pending = []
         for row in rows:
             ID = row['ת.ז']
 
@@ -209,6 +349,7 @@ class BaserowAutomations:
             except AssertionError:
                 continue
             
+            values = {'id': row.id}
             for engine, field_name, first_name_field, last_name_field in (
                 (rishumon_query_engine, 'שם רישומון', 'Name', 'Family'),
                 (elector_query_engine, 'שם אלקטור', 'first_name', 'last_name')
@@ -216,11 +357,16 @@ class BaserowAutomations:
                 if engine:
                     query_results = engine.query(ID=ID)
                     if query_results:
-                        row[field_name] = f'{query_results[0][first_name_field]} {query_results[0][last_name_field]}'
+                        name = f'{query_results[0][first_name_field]} {query_results[0][last_name_field]}'
                     else:
-                        row[field_name] = 'NOT FOUND'
-                    
-                    self.update_row_safe(row)
+                        name = 'NOT FOUND'
+                    if row[field_name] != name:
+                        values[field_name] = name
+
+            if len(values) > 1:
+                self._queue_update(self.table_activists, pending, values)
+
+        self._flush_updates(self.table_activists, pending)
 
     def fill_birthday_by_id(self, rishumon_query_engine):
         rishumon_name_found_filter = Filter('שם רישומון', 'NOT FOUND', 'not_equal')
@@ -230,35 +376,48 @@ class BaserowAutomations:
         filters = [rishumon_name_found_filter, valid_id_filter]
 
         rows = self.table_activists.get_rows(filters=filters)
+        pending = []
         for row in rows:
             ID = row['ת.ז']
             query_results = rishumon_query_engine.query(ID=ID)
             if query_results:
                 bd = query_results[0]['BDate']
-                row['ת. לידה רישומון'] = f'{bd[0:4]}-{bd[4:6]}-{bd[6:8]}'
-                
-                self.update_row_safe(row)
+                self._queue_update(self.table_activists, pending, {
+                    'id': row.id,
+                    'ת. לידה רישומון': f'{bd[0:4]}-{bd[4:6]}-{bd[6:8]}'
+                })
+
+        self._flush_updates(self.table_activists, pending)
     
     def link_activists_and_recruitments(self):
         """Updates in the classification table whether one is a candidate for
         recruitment, and links their classification status to the recruitment
         table."""
         recruitment_rows = self.recruitment_table.get_rows()
-        recruitment_phones = {r['טלפון'].strip(): i for i, r in enumerate(recruitment_rows)}
+        recruitment_phones = {_intern(r['טלפון'].strip()): r for r in recruitment_rows
+                              if r['טלפון']}
 
         phone_filter = Filter('_NormalizedPhoneNumber', '', 'not_empty')
         activists_rows = self.table_activists.get_rows(filters=[phone_filter])
+        pending = []
+        # keyed by row id, since several activists may share a recruitment row
+        recruitment_updates = {}
         for r in activists_rows:
-            phone = r['_NormalizedPhoneNumber']
-            if phone in recruitment_phones:
-                r['מועמד.ת לצוות'] = 'כן'
-                recruitment_row = recruitment_rows[recruitment_phones[phone]]
-                recruitment_row['פעילי שטח'] = [r.id]
-                recruitment_row.update()
+            phone = _intern(r['_NormalizedPhoneNumber'])
+            recruitment_row = recruitment_phones.get(phone)
+            if recruitment_row is not None:
+                is_candidate = 'כן'
+                recruitment_updates[recruitment_row.id] = {'id': recruitment_row.id,
+                                                           'פעילי שטח': [r.id]}
             else:
-                r['מועמד.ת לצוות'] = 'לא'
-            
-            self.update_row_safe(r)
+                is_candidate = 'לא'
+
+            if r['מועמד.ת לצוות'] != is_candidate:
+                self._queue_update(self.table_activists, pending,
+                                   {'id': r.id, 'מועמד.ת לצוות': is_candidate})
+
+        self._flush_updates(self.table_activists, pending)
+        self._flush_updates(self.recruitment_table, list(recruitment_updates.values()))
 
     def get_activists_to_save_as_contact(self):
         table = self.baserow.get_table(self.table_activists)
@@ -292,25 +451,19 @@ class BaserowAutomations:
         args:
             rows - to rows to process
             name_field - the name of the field of names"""
-        phones_to_names = {}
+        phones_to_names = defaultdict(list)
         for row in rows:
-            phone = row['_NormalizedPhoneNumber']
-            name = row[name_field]
-            if phone not in phones_to_names:
-                phones_to_names[phone] = []
-            phones_to_names[phone].append(name)
-        
-        keys_to_delete = []
-        for phone in phones_to_names:
-            if len(phones_to_names[phone]) < 2:
-                keys_to_delete.append(phone)
-        for phone in keys_to_delete:
-            del phones_to_names[phone]
-        
-        return phones_to_names
+            phones_to_names[_intern(row['_NormalizedPhoneNumber'])].append(
+                _intern(row[name_field]))
+
+        return {phone: names for phone, names in phones_to_names.items() if len(names) >= 2}
 
     def find_duplicates_in_activists(self):
-        return self.find_duplicates(self.table_activists.get_rows(), 'שם מלא')
+        rows = self.table_activists.get_rows(
+            include=['_NormalizedPhoneNumber', 'שם מלא'], iterator=True)
+        return self.find_duplicates(rows, 'שם מלא')
 
     def find_duplicates_in_registrations(self):
-        return self.find_duplicates(self.table_event_registration.get_rows(), 'שם מלא')
+        rows = self.table_event_registration.get_rows(
+            include=['_NormalizedPhoneNumber', 'שם מלא'], iterator=True)
+        return self.find_duplicates(rows, 'שם מלא')